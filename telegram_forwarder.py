@@ -6,12 +6,18 @@ With Forwarded-From Channel Extraction in API
 
 import asyncio
 import os
+import time
 from telethon import TelegramClient, events
 from telethon.sessions import StringSession
 import logging
 from datetime import datetime, timedelta
-from fastapi import FastAPI, HTTPException, Depends, Header
+import orjson
+import redis.asyncio as redis
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import uvicorn
+import uvloop
 from contextlib import asynccontextmanager
 
 # Configure logging for Railway
@@ -36,11 +42,130 @@ TARGET_CHANNEL = os.getenv('TARGET_CHANNEL', 'YourPrivateChannel')
 # API security for n8n (optional)
 N8N_API_KEY = os.getenv('N8N_API_KEY', '')
 
+# Web processes under gunicorn set FORWARDING_ENABLED=0 so only the
+# dedicated worker process registers the forward handler
+FORWARDING_ENABLED = os.getenv('FORWARDING_ENABLED', '1') == '1'
+
+# Redis ring buffer of forwarded messages: the worker writes each forward
+# into a sorted set keyed by timestamp, the API reads it back without
+# touching Telegram
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+HISTORY_KEY = 'fwd:hist'
+CHANNEL_ID_KEY = 'fwd:channel_id'
+LAST_ID_KEY = 'fwd:last_id'
+HISTORY_RETENTION_SECONDS = 7 * 86400
+
+redis_client = redis.from_url(REDIS_URL)
+
 # Global variables
 telegram_client = None
 target_channel_id = None
 source_entity = None
 target_entity = None
+# Pre-resolved InputPeers so hot paths skip Telethon's per-call entity lookup
+source_input_peer = None
+target_input_peer = None
+# t.me/c/ link prefix for the target channel, set once at init
+link_prefix = None
+
+# Short-lived cache so repeated n8n polls with the same `hours` don't
+# re-read and re-decode the Redis history
+_msg_cache = TTLCache(maxsize=32, ttl=60)
+
+# Connection state cached briefly so healthcheck polls (~1/s on Railway)
+# don't touch the MTProto sender's state on every probe
+_connected_cached = False
+_connected_ts = 0.0
+
+# Message IDs queue up here and a single consumer coalesces bursts into
+# one batched forward_messages RPC
+_forward_queue = asyncio.Queue()
+_forward_consumer_task = None
+FORWARD_BATCH_SIZE = 20
+
+def _is_connected() -> bool:
+    """Telegram connection state, refreshed at most every 5 seconds"""
+    global _connected_cached, _connected_ts
+    now = time.monotonic()
+    if now - _connected_ts >= 5:
+        _connected_cached = telegram_client is not None and telegram_client.is_connected()
+        _connected_ts = now
+    return _connected_cached
+
+def _forward_info(message):
+    """Extract forwarded-from channel info from a message, if any"""
+    fwd_name = None
+    fwd_handle = None
+    fwd_id = None
+    if message.forward:
+        # Try to get channel entity (works for channels, not users)
+        if hasattr(message.forward, "chat") and message.forward.chat:
+            fwd_name = getattr(message.forward.chat, "title", None)
+            fwd_handle = getattr(message.forward.chat, "username", None)
+            fwd_id = getattr(message.forward.chat, "id", None)
+        elif hasattr(message.forward, "sender_id"):
+            fwd_id = message.forward.sender_id
+    return fwd_name, fwd_handle, fwd_id
+
+async def _record_forward(forwarded):
+    """Push the forwarded message into the Redis history ring buffer"""
+    text = (forwarded.text or '').strip()
+    if not text:
+        # Media-only message: the API never serves it, so don't pay for
+        # the write (or bust caches/ETags) at all
+        return
+
+    fwd_name, fwd_handle, fwd_id = _forward_info(forwarded)
+    ts = int(forwarded.date.timestamp())
+    record = orjson.dumps({
+        'message_id': forwarded.id,
+        'text': text,
+        'date': ts,
+        'readable_date': forwarded.date,
+        'link': link_prefix + str(forwarded.id),
+        'forwarded_from_name': fwd_name,
+        'forwarded_from_handle': fwd_handle,
+        'forwarded_from_id': fwd_id
+    })
+    await redis_client.zadd(HISTORY_KEY, {record: ts})
+    await redis_client.set(LAST_ID_KEY, forwarded.id)
+    await redis_client.zremrangebyscore(
+        HISTORY_KEY, 0, ts - HISTORY_RETENTION_SECONDS
+    )
+    _msg_cache.clear()  # New content - drop stale API responses
+
+async def _forward_consumer():
+    """Drain the forward queue, coalescing bursts into one batched RPC"""
+    while True:
+        batch = [await _forward_queue.get()]
+        try:
+            while len(batch) < FORWARD_BATCH_SIZE:
+                batch.append(_forward_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            pass
+
+        try:
+            forwarded = await telegram_client.forward_messages(
+                entity=target_input_peer,
+                messages=batch,
+                from_peer=source_input_peer
+            )
+            if not isinstance(forwarded, list):
+                forwarded = [forwarded]
+            logger.info(f"✅ Forwarded {len(batch)} message(s) from {source_entity.title}")
+
+        except Exception as e:
+            logger.error(f"❌ Forward failed: {e}")
+            continue
+
+        for message in forwarded:
+            if message is None:
+                # Telegram couldn't forward this one (e.g. it was deleted)
+                continue
+            try:
+                await _record_forward(message)
+            except Exception as e:
+                logger.error(f"❌ History record failed for message {message.id}: {e}")
 
 async def verify_api_key(x_api_key: str = Header(None)):
     """Verify API key for n8n requests (optional if no key set)"""
@@ -51,6 +176,7 @@ async def verify_api_key(x_api_key: str = Header(None)):
 async def init_telegram():
     """Initialize Telegram client and forwarding"""
     global telegram_client, target_channel_id, source_entity, target_entity
+    global source_input_peer, target_input_peer, link_prefix
     
     logger.info("🚀 Initializing Telegram client...")
     
@@ -89,27 +215,38 @@ async def init_telegram():
                 source_entity = await telegram_client.get_entity(SOURCE_CHANNEL)
                 target_entity = await telegram_client.get_entity(TARGET_CHANNEL)
                 target_channel_id = target_entity.id
-                
+
+                # Resolve once; the channels never change at runtime
+                source_input_peer = await telegram_client.get_input_entity(source_entity)
+                target_input_peer = await telegram_client.get_input_entity(target_entity)
+
+                # Link prefix is the channel ID without the -100 prefix
+                link_prefix = f"https://t.me/c/{str(abs(target_channel_id))[3:]}/"
+
+                # Publish the channel ID so API-only web processes can
+                # report it without a Telethon client
+                await redis_client.set(CHANNEL_ID_KEY, target_channel_id)
+
                 logger.info(f"📡 Source: {source_entity.title}")
                 logger.info(f"📥 Target: {target_entity.title} (ID: {target_channel_id})")
                 
-                # Set up message forwarding
-                @telegram_client.on(events.NewMessage(chats=[source_entity]))
+                # Set up message forwarding. The bare channel ID lets the
+                # update dispatcher compare integers instead of resolving
+                # the entity for every incoming update.
+                @telegram_client.on(events.NewMessage(
+                    chats=[source_input_peer.channel_id], incoming=True
+                ))
                 async def forward_handler(event):
-                    try:
-                        await telegram_client.forward_messages(
-                            entity=target_entity,
-                            messages=event.message,
-                            from_peer=source_entity
-                        )
-                        logger.info(f"✅ Forwarded message {event.message.id} from {source_entity.title}")
-                        
-                    except Exception as e:
-                        logger.error(f"❌ Forward failed: {e}")
-                
+                    # Enqueue only, so a Telegram RTT spike doesn't stall
+                    # dispatch; the consumer batches bursts into one RPC
+                    _forward_queue.put_nowait(event.message.id)
+
+                global _forward_consumer_task
+                _forward_consumer_task = asyncio.create_task(_forward_consumer())
+
                 logger.info(f"🚀 Auto-forwarding ACTIVE: {SOURCE_CHANNEL} → {TARGET_CHANNEL}")
                 logger.info("🔄 Listening for new messages...")
-                
+
                 return True
                 
             except Exception as e:
@@ -127,27 +264,41 @@ async def init_telegram():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage Telegram client lifecycle"""
+    global target_channel_id
+
     logger.info("🌟 Starting application...")
-    
-    # Initialize Telegram
-    success = await init_telegram()
-    if success:
-        logger.info("✅ Telegram forwarding initialized successfully")
+
+    if FORWARDING_ENABLED:
+        # Single-process mode: run the forwarder alongside the API
+        success = await init_telegram()
+        if success:
+            logger.info("✅ Telegram forwarding initialized successfully")
+        else:
+            logger.error("❌ Telegram forwarding failed to initialize")
     else:
-        logger.error("❌ Telegram forwarding failed to initialize")
-    
+        # API-only web process: history comes from Redis, no Telethon
+        # client needed at all
+        cid = await redis_client.get(CHANNEL_ID_KEY)
+        if cid:
+            target_channel_id = int(cid)
+        logger.info("📖 API-only mode: serving history from Redis")
+
     yield
-    
+
     # Cleanup
+    if _forward_consumer_task:
+        _forward_consumer_task.cancel()
     if telegram_client:
         logger.info("🔄 Disconnecting Telegram client...")
         await telegram_client.disconnect()
+    await redis_client.aclose()
 
 # FastAPI app with lifespan management
 app = FastAPI(
-    title="Telegram Forwarder + n8n API", 
+    title="Telegram Forwarder + n8n API",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 @app.get("/")
@@ -156,7 +307,7 @@ async def root():
     return {
         "service": "Telegram Forwarder + n8n API",
         "status": "running",
-        "telegram_connected": telegram_client is not None and telegram_client.is_connected() if telegram_client else False,
+        "telegram_connected": _is_connected(),
         "target_channel": target_channel_id,
         "api_key_required": bool(N8N_API_KEY),
         "forwarding_active": source_entity is not None and target_entity is not None,
@@ -174,80 +325,96 @@ async def health_check():
     return {
         "status": "healthy", 
         "timestamp": datetime.now().isoformat(),
-        "telegram_connected": telegram_client is not None and telegram_client.is_connected() if telegram_client else False,
+        "telegram_connected": _is_connected(),
         "target_channel_configured": target_channel_id is not None,
         "forwarding_configured": source_entity is not None and target_entity is not None,
         "api_auth": "enabled" if N8N_API_KEY else "disabled"
     }
 
+async def _fetch_messages(hours: int, last_id: int = 0) -> list[dict]:
+    """Fetch recent text messages from the Redis ring buffer (TTL-cached),
+    with forwarded-from info included"""
+    # Serve repeated polls from the cache instead of hitting Redis. The
+    # worker's cache invalidation can't reach other processes, so a
+    # cached list is only trusted if it already contains the newest
+    # forwarded message ID the caller knows about.
+    messages = _msg_cache.get(hours)
+    if messages is not None:
+        newest = max((m['message_id'] for m in messages), default=0)
+        if last_id <= newest:
+            logger.info(f"📊 API: Served {len(messages)} messages from cache (last {hours} hours)")
+            return messages
+
+    ts_threshold = int(time.time()) - hours * 3600
+
+    # Slice of the ring buffer the forwarder maintains; no Telegram
+    # round trip per API request at all. The window is already bounded
+    # by the 7-day retention trim, so load it whole - capping here would
+    # truncate in zset order, where a same-second tie at the boundary
+    # can keep an older ID and drop a newer one
+    raw = await redis_client.zrevrangebyscore(
+        HISTORY_KEY, '+inf', ts_threshold
+    )
+
+    # Text-only filtering happens once at write time in _record_forward,
+    # so every record here is servable as-is
+    messages = [orjson.loads(r) for r in raw]
+
+    # Sort by date (newest first). The zset only orders by whole-second
+    # score, with member-byte tie-breaks, so the contract needs to be
+    # imposed explicitly here
+    messages.sort(key=lambda m: (m['date'], m['message_id']), reverse=True)
+
+    messages = messages[:200]  # Reasonable limit, applied post-sort
+
+    _msg_cache[hours] = messages
+
+    logger.info(f"📊 API: Retrieved {len(messages)} messages from last {hours} hours")
+
+    return messages
+
 @app.get("/api/messages/{hours}")
 async def get_recent_messages(
+    request: Request,
     hours: int = 24,
     api_key_valid: bool = Depends(verify_api_key)
 ):
     """Get recent messages from the target channel for n8n processing, with forwarded-from info included"""
-    if not telegram_client or not telegram_client.is_connected():
-        raise HTTPException(status_code=503, detail="Telegram client not connected")
-    
-    if not target_channel_id:
-        raise HTTPException(status_code=503, detail="Target channel not configured")
-    
     try:
-        # Calculate time range
+        # The newest forwarded ID both busts a stale per-process cache in
+        # _fetch_messages and anchors the ETag below
+        last_id = await redis_client.get(LAST_ID_KEY)
+        last_id = int(last_id) if last_id else 0
+
         time_threshold = datetime.now() - timedelta(hours=hours)
-        
-        # Fetch messages from target channel (where forwarded messages are stored)
-        messages = []
-        async for message in telegram_client.iter_messages(
-            target_channel_id, 
-            offset_date=time_threshold,
-            reverse=False,  # Get newest first
-            limit=200  # Reasonable limit
-        ):
-            if message.text and message.text.strip():
-                # Extract channel ID without the -100 prefix for the link
-                channel_id_for_link = str(abs(target_channel_id))[3:]  # Remove -100 prefix
-                message_link = f"https://t.me/c/{channel_id_for_link}/{message.id}"
-
-                # --- NEW: Get forwarded-from channel info ---
-                fwd_name = None
-                fwd_handle = None
-                fwd_id = None
-                if message.forward:
-                    # Try to get channel entity (works for channels, not users)
-                    if hasattr(message.forward, "chat") and message.forward.chat:
-                        fwd_name = getattr(message.forward.chat, "title", None)
-                        fwd_handle = getattr(message.forward.chat, "username", None)
-                        fwd_id = getattr(message.forward.chat, "id", None)
-                    elif hasattr(message.forward, "sender_id"):
-                        fwd_id = message.forward.sender_id
-
-                messages.append({
-                    'message_id': message.id,
-                    'text': message.text.strip(),
-                    'date': int(message.date.timestamp()),
-                    'readable_date': message.date.isoformat(),
-                    'link': message_link,
-                    'text_with_link': message.text.strip() + f"\n🔗 Source: {message_link}",
-                    # --- NEW FIELDS ---
-                    'forwarded_from_name': fwd_name,
-                    'forwarded_from_handle': fwd_handle,
-                    'forwarded_from_id': fwd_id
-                })
-        
-        # Sort by date (newest first)
-        messages.sort(key=lambda x: x['date'], reverse=True)
-        
-        logger.info(f"📊 API: Retrieved {len(messages)} messages from last {hours} hours")
-        
-        return {
+        messages = await _fetch_messages(hours, last_id)
+
+        # ETag is derived from what is actually served, so a 304 can
+        # never hide a message the client hasn't seen. max() rather than
+        # the list head: Redis breaks same-second ties by member bytes,
+        # so the head isn't guaranteed to carry the highest ID
+        newest_served = max((m['message_id'] for m in messages), default=0)
+        etag = f'W/"{newest_served}-{hours}"'
+        if request.headers.get('if-none-match') == etag:
+            return Response(status_code=304)
+
+        # text_with_link is only materialized for this endpoint's clients;
+        # _fetch_messages keeps just text + link
+        messages = [
+            {**m, 'text_with_link': f"{m['text']}\n🔗 Source: {m['link']}"}
+            for m in messages
+        ]
+
+        # Serialize with orjson directly: returning a Response skips
+        # FastAPI's jsonable_encoder walk over every message dict
+        return ORJSONResponse({
             'success': True,
             'messages': messages,
             'message_count': len(messages),
             'hours_requested': hours,
-            'time_threshold': time_threshold.isoformat(),
-            'channel_id': str(target_channel_id)
-        }
+            'time_threshold': time_threshold,
+            'channel_id': str(target_channel_id) if target_channel_id else None
+        }, headers={'ETag': etag})
         
     except Exception as e:
         logger.error(f"❌ API Error fetching messages: {str(e)}")
@@ -261,11 +428,11 @@ async def get_combined_messages(
     hours: int = 24,
     api_key_valid: bool = Depends(verify_api_key)
 ):
-    """Get recent messages formatted for AI processing (combined text)"""
+    """Stream recent messages formatted for AI processing (combined text)"""
     try:
-        # Get messages using the existing endpoint logic
-        result = await get_recent_messages(hours, api_key_valid)
-        
+        # Share the fetch with /api/messages instead of re-dispatching through it
+        messages = await _fetch_messages(hours)
+
         # Create combined text for AI input
         # INCLUDE forwarded-from info if available
         def format_message(msg):
@@ -278,19 +445,19 @@ async def get_combined_messages(
                 src = msg['link']
             return f"{msg['text']}\nИсточник: {src}"
 
-        combined_text = '\n\n---\n\n'.join([
-            format_message(msg) for msg in result['messages']
-        ])
-        
-        logger.info(f"📝 API: Created combined text from {result['message_count']} messages")
-        
-        return {
-            'success': True,
-            'combined_text': combined_text,
-            'message_count': result['message_count'],
-            'messages': result['messages'],
-            'processing_date': datetime.now().date().isoformat()
-        }
+        # Stream chunk by chunk: the client sees bytes before the whole
+        # text exists, and we never hold the full combined string in memory
+        async def generate():
+            first = True
+            for msg in messages:
+                if not first:
+                    yield b'\n\n---\n\n'
+                yield format_message(msg).encode()
+                first = False
+
+        logger.info(f"📝 API: Streaming combined text from {len(messages)} messages")
+
+        return StreamingResponse(generate(), media_type="text/plain; charset=utf-8")
         
     except Exception as e:
         logger.error(f"❌ API Error creating combined messages: {str(e)}")
@@ -299,14 +466,24 @@ async def get_combined_messages(
             detail=f"Error creating combined messages: {str(e)}"
         )
 
-# Run the server
-if __name__ == "__main__":
+async def main():
+    """Serve FastAPI on the same event loop that runs the Telethon client"""
     port = int(os.getenv("PORT", 8000))
     logger.info(f"🌐 Starting Telegram Forwarder + FastAPI on port {port}")
-    
-    uvicorn.run(
-        app, 
-        host="0.0.0.0", 
+
+    config = uvicorn.Config(
+        app,
+        host="0.0.0.0",
         port=port,
+        loop="uvloop",
+        http="httptools",
         log_level="info"
     )
+    server = uvicorn.Server(config)
+    await server.serve()
+
+# Run the server
+if __name__ == "__main__":
+    # uvloop also backs Telethon's MTProto socket I/O, not just uvicorn
+    uvloop.install()
+    asyncio.run(main())
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Forwarder-only worker process for Railway.
+
+Runs the Telethon client and the auto-forwarding handler without the HTTP
+API; the `web` processes (gunicorn + UvicornWorker) serve the API and run
+in API-only mode, so CPU spent building responses never blocks forwarding.
+"""
+
+import asyncio
+
+import uvloop
+
+import telegram_forwarder as tf
+from telegram_forwarder import init_telegram, logger
+
+
+async def main():
+    success = await init_telegram()
+    if not success:
+        logger.error("❌ Worker failed to initialize Telegram")
+        raise SystemExit(1)
+
+    await tf.telegram_client.run_until_disconnected()
+
+
+if __name__ == "__main__":
+    uvloop.install()
+    asyncio.run(main())